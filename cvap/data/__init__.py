@@ -2,6 +2,7 @@ from .esc50 import build_xfold_dataloader_list
 from .audio_text import build_audio_text_dataloader
 from .image_text import build_image_text_dataloader
 from .image_audio import build_image_audio_dataloader
+from .prefetch import BackgroundPrefetcher, CUDAPrefetcher
 
 from .audioset_clf import build_audioset_clf_dataloader
 
@@ -130,9 +130,9 @@ class AudioTextCollator:
             raise ValueError(f"unrecognized `{type(text_list[0][0])}`")
         # https://stackoverflow.com/a/38619333
         text = np.array(list(itertools.zip_longest(*text_list, fillvalue=0))).T
-        return (
-            np.concatenate(union["audio"], axis=0),
-            text,
+        return ( # CPU tensors so that they can be pinned by the dataloader
+            torch.from_numpy(np.concatenate(union["audio"], axis=0)),
+            torch.from_numpy(text),
             name,
         )
 
@@ -160,6 +160,7 @@ def build_dataloader(cfg, data_list, dataset_cls, shuffle=True, train=True, coll
         batch_size=per_device_batch_size,
         collate_fn=collator_cls(),
         num_workers=(0 if ddp_mode else cfg.num_proc),
+        persistent_workers=(not ddp_mode and cfg.num_proc > 0),
         pin_memory=True,
         sampler=sampler,
         drop_last=(True if ddp_mode else False),
@@ -314,19 +314,21 @@ class ImageAudioCollator:
         union = { 
             k: [record.get(k) for record in records] for k in set().union(*records) 
         } 
-        if "image_v1" in union:
+        if "image_v1" in union: # CPU tensors so that they can be pinned by the dataloader
             return (
-                np.concatenate(union["image"], axis=0),
-                np.concatenate(union["image_v1"], axis=0),
-                np.concatenate(union["image_v2"], axis=0),
-                np.concatenate(union["audio_v1"], axis=0),
-                np.concatenate(union["audio_v2"], axis=0),
+                torch.from_numpy(np.concatenate(union["image"], axis=0)),
+                torch.from_numpy(np.concatenate(union["image_v1"], axis=0)),
+                torch.from_numpy(np.concatenate(union["image_v2"], axis=0)),
+                torch.from_numpy(np.concatenate(union["audio_v1"], axis=0)),
+                torch.from_numpy(np.concatenate(union["audio_v2"], axis=0)),
                 union["name"],
             )
         else:
             return (
-                np.concatenate(union["image"], axis=0),
-                np.concatenate(union["audio"], axis=0),
+                torch.from_numpy(np.concatenate(union["image"], axis=0)),
+                torch.from_numpy( # (b, 1, h, w): the channel dim is added once here
+                    np.expand_dims(np.concatenate(union["audio"], axis=0), 1)
+                ),
                 union["name"],
             )
 
@@ -368,6 +370,7 @@ def build_image_audio_dataloader(cfg, data_name, shuffle=True, train=True):
         batch_size=per_device_batch_size,
         collate_fn=ImageAudioCollator(),
         num_workers=(0 if ddp_mode else cfg.num_proc),
+        persistent_workers=(not ddp_mode and cfg.num_proc > 0),
         pin_memory=True,
         sampler=sampler,
         drop_last=(True if ddp_mode else False),
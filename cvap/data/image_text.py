@@ -143,9 +143,9 @@ class ImageTextCollator:
             raise ValueError(f"unrecognized `{type(text_list[0][0])}`")
         # https://stackoverflow.com/a/38619333
         text = np.array(list(itertools.zip_longest(*text_list, fillvalue=0))).T
-        return (
-            np.concatenate(union["image"], axis=0),
-            text,
+        return ( # CPU tensors so that they can be pinned by the dataloader
+            torch.from_numpy(np.concatenate(union["image"], axis=0)),
+            torch.from_numpy(text),
             name,
         )
 
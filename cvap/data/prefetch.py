@@ -0,0 +1,107 @@
+import queue
+import threading
+import torch
+
+__all__ = ["BackgroundPrefetcher", "CUDAPrefetcher"]
+
+class _Failure:
+    def __init__(self, exception):
+        self.exception = exception
+
+class BackgroundPrefetcher:
+    """ iterate over `loader` in a background thread that keeps up to `depth` batches ready,
+        so that data loading (done in the main process under ddp) overlaps with the model step.
+    """
+    _END = object()
+
+    def __init__(self, loader, depth=4):
+        self.loader = loader
+        self.depth = max(depth, 1)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        batches = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set(): # give up once the consumer has left
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        # pin memory on this rank's gpu, the same as the pin thread of DataLoader
+        device = torch.cuda.current_device() if torch.cuda.is_available() else None
+
+        def produce():
+            if device is not None:
+                torch.cuda.set_device(device)
+            last = self._END
+            try:
+                for batch in self.loader:
+                    if not put(batch):
+                        return
+            except BaseException as e:
+                last = _Failure(e)
+            finally: # the consumer always gets an end marker (a no-op once it has left)
+                put(last)
+
+        thread = threading.Thread(target=produce, daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = batches.get()
+                if item is self._END:
+                    break
+                if isinstance(item, _Failure):
+                    raise item.exception
+                yield item
+        finally:
+            stop.set()
+            thread.join()
+
+class CUDAPrefetcher:
+    """ copy the tensors of the next batch to `device` on a side stream while the current batch
+        is being consumed; the dataloader should return pinned memory for the copies to be async.
+    """
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = torch.device(device)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _to_device(self, batch):
+        return type(batch)(
+            x.to(self.device, non_blocking=True) if torch.is_tensor(x) else x for x in batch
+        )
+
+    def __iter__(self):
+        if self.device.type != "cuda":
+            yield from self.loader
+            return
+        copy_stream = torch.cuda.Stream(device=self.device)
+        batches = iter(self.loader)
+
+        def preload():
+            try:
+                batch = next(batches)
+            except StopIteration:
+                return None
+            with torch.cuda.stream(copy_stream):
+                return self._to_device(batch)
+
+        next_batch = preload()
+        while next_batch is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(copy_stream)
+            batch = next_batch
+            for x in batch: # the memory was allocated on the copy stream
+                if torch.is_tensor(x) and x.is_cuda:
+                    x.record_stream(current_stream)
+            next_batch = preload()
+            yield batch
@@ -4,14 +4,13 @@ import torch
 from torch import nn
 
 import torch.distributed as dist
-from torch.nn.parallel import data_parallel
 from collections import defaultdict, OrderedDict
 
 from ..module import (
     build_image_head, build_audio_head, build_text_head, build_loss_head
 )
 from . import (
-    load_checkpoint, load_clip, load_meme
+    load_checkpoint, load_clip, load_meme, maybe_data_parallel
 )
 
 from clip import load 
@@ -28,12 +27,12 @@ class CLAP(nn.Module):
         device_ids = kwargs.get("device_ids", [0])
         # how to asynchronize the two `data_parallel`
         kwargs = {"normalized": False, "require_feature": True, "names": kwargs.get("names", None)}
-        _, audio_features = data_parallel(
+        _, audio_features = maybe_data_parallel(
             self.audio_head, audios, device_ids=device_ids, module_kwargs=kwargs
         )
         time_first = True #self.audio_head.time_first
         text_input = (text, audio_features, time_first)
-        _, logits, predictions = data_parallel(
+        _, logits, predictions = maybe_data_parallel(
             self.text_head, text_input, device_ids=device_ids, module_kwargs=kwargs
         )
         loss = self.loss_head(logits, text[:, 1:], predictions, **kwargs)
@@ -43,17 +42,17 @@ class CLAP(nn.Module):
         device_ids = kwargs.get("device_ids", [0])
         # how to asynchronize the two `data_parallel`
         kwargs = {"normalized": self.loss_head.normalized, "names": kwargs.get("names", None)}
-        audio_features = data_parallel(
+        audio_features = maybe_data_parallel(
             self.audio_head, audios, device_ids=device_ids, module_kwargs=kwargs
         )
-        text_features = data_parallel(
+        text_features = maybe_data_parallel(
             self.text_head, text, device_ids=device_ids, module_kwargs=kwargs
         )
         loss = self.loss_head(audio_features, text_features, **kwargs)
         return loss
 
     def encode_text(self, text, *args, device_ids=[0], **kwargs):
-        text_features = data_parallel(
+        text_features = maybe_data_parallel(
             self.text_head, text, device_ids=device_ids, module_kwargs=kwargs
         )
         return text_features
@@ -153,6 +152,14 @@ class CLAP(nn.Module):
                 })
             elif self.text_head is not None:
                 self.echo("Freeze text encoder.")
+            if getattr(self.cfg.running, "grad_ckpt", False):
+                nckpt = 0
+                for module in self.audio_head.modules():
+                    if hasattr(module, "grad_ckpt"):
+                        module.grad_ckpt = True
+                        nckpt += 1
+                if nckpt > 0:
+                    self.echo("Checkpoint activations of the audio encoder.")
             self.cuda(self.cfg.rank)
         return tunable_params
 
@@ -4,13 +4,12 @@ import torch
 from torch import nn
 
 import torch.distributed as dist
-from torch.nn.parallel import data_parallel
 
 from ..module import (
     build_image_head, build_audio_head, build_text_head, build_loss_head
 )
 from . import (
-    load_checkpoint, load_clip, load_meme
+    load_checkpoint, load_clip, load_meme, maybe_data_parallel
 )
 
 from clip import load 
@@ -26,14 +25,14 @@ class CVAP(nn.Module):
         # how to asynchronize the two `data_parallel` 
         kwargs = {"normalized": self.loss_head.normalized, "names": kwargs.get("names", None)}
         if self.image_head is not None:
-            image_features = data_parallel(
+            image_features = maybe_data_parallel(
                 self.image_head, images, device_ids=device_ids, module_kwargs=kwargs
             )
         else: # pre-computed unnormalized features
             if self.loss_head.normalized:
                 images = images / images.norm(dim=-1, keepdim=True)
             image_features = images
-        audio_features = data_parallel(
+        audio_features = maybe_data_parallel(
             self.audio_head, audios, device_ids=device_ids, module_kwargs=kwargs
         )
         loss = self.loss_head(image_features, audio_features, **kwargs)
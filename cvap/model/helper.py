@@ -1,11 +1,22 @@
 from omegaconf import OmegaConf
 import os, re
 import torch
+from torch.nn.parallel import data_parallel
 from collections import OrderedDict
 
 from clip import load 
 
-__all__ = ["load_checkpoint", "load_clip", "load_meme", "extract_model_file"]
+__all__ = ["load_checkpoint", "load_clip", "load_meme", "extract_model_file", "maybe_data_parallel"]
+
+def maybe_data_parallel(module, inputs, device_ids=None, module_kwargs=None):
+    """ `data_parallel` replicates the module at every call; call the module in place when there
+        is nothing to parallelize, e.g., under DDP (`device_ids=None`) or on a single gpu.
+    """
+    if device_ids is not None and len(device_ids) > 1:
+        return data_parallel(module, inputs, device_ids=device_ids, module_kwargs=module_kwargs)
+    if not isinstance(inputs, tuple):
+        inputs = (inputs,)
+    return module(*inputs, **(module_kwargs or {}))
 
 def load_checkpoint(cfg, echo):
     model_file = f"{cfg.model_root}/{cfg.model_name}/{cfg.model_file}"
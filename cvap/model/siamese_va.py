@@ -13,7 +13,6 @@ from PIL import Image
 from tqdm import tqdm
 
 import torch.distributed as dist
-from torch.nn.parallel import data_parallel
 from torch.nn.parallel import DistributedDataParallel
 
 from clip import load 
@@ -23,7 +22,7 @@ from ..module import (
     build_image_head, build_audio_head, build_text_head, build_loss_head
 )
 from . import (
-    load_checkpoint, load_clip, load_meme
+    load_checkpoint, load_clip, load_meme, maybe_data_parallel
 )
 
 class CVASP(CVALP):
@@ -44,19 +43,19 @@ class CVASP(CVALP):
                 images = images / images.norm(dim=-1, keepdim=True)
             image_features = images # dummy images will be ignored
         if images_v1 is not None and self.image_head is not None:
-            image_features_v1 = data_parallel(
+            image_features_v1 = maybe_data_parallel(
                 self.image_head, images_v1, device_ids=device_ids, module_kwargs=kwargs
             )
         if images_v2 is not None and self.image_head is not None:
-            image_features_v2 = data_parallel(
+            image_features_v2 = maybe_data_parallel(
                 self.image_head, images_v2, device_ids=device_ids, module_kwargs=kwargs
             )
         if audios_v1 is not None and self.audio_head is not None:
-            audio_features_v1 = data_parallel(
+            audio_features_v1 = maybe_data_parallel(
                 self.audio_head, audios_v1, device_ids=device_ids, module_kwargs=kwargs
             )
         if text_v1 is not None and self.text_head is not None:
-            text_features = data_parallel(
+            text_features = maybe_data_parallel(
                 self.text_head, text_v1, device_ids=device_ids, module_kwargs=kwargs
             )
         loss = self.loss_head(
@@ -22,10 +22,53 @@ try:
 except ImportError:
     ac_metric = lambda x, y: None # TODO not supported
     pass
+try:
+    from numba import njit, prange
+except ImportError:
+    njit, prange = None, range # fall back to the per-label `precision_recall_curve`
 
 from .loss_head import build_loss_head, LossHead
 
 
+def _pr_midpoints(y_true, y_score):
+    """ mirror `metrics.precision_recall_curve` and take its middle point per label.
+        y_true and y_score are (nlabel, nsample) float64 arrays.
+    """
+    nlabel, nsample = y_score.shape
+    precisions = np.empty(nlabel)
+    recalls = np.empty(nlabel)
+    for k in prange(nlabel):
+        order = np.argsort(-y_score[k], kind="mergesort")
+        score = y_score[k][order]
+        label = y_true[k][order]
+        # true / false positives at the last index of every distinct score
+        tps = np.empty(nsample)
+        fps = np.empty(nsample)
+        nthreshold = 0
+        tp = 0.
+        for i in range(nsample):
+            tp += label[i]
+            if i == nsample - 1 or score[i] != score[i + 1]:
+                tps[nthreshold] = tp
+                fps[nthreshold] = i + 1 - tp
+                nthreshold += 1
+        # the curve stops once full recall is reached and ends with (p=1, r=0)
+        last_ind = 0
+        while tps[last_ind] < tps[nthreshold - 1]:
+            last_ind += 1
+        mid = (last_ind + 2) // 2
+        if mid <= last_ind:
+            j = last_ind - mid
+            precisions[k] = tps[j] / (tps[j] + fps[j])
+            recalls[k] = tps[j] / tps[nthreshold - 1]
+        else:
+            precisions[k] = 1.
+            recalls[k] = 0.
+    return precisions, recalls
+
+if njit is not None:
+    _pr_midpoints = njit(parallel=True, cache=True)(_pr_midpoints)
+
 class BCELossHead(LossHead):
     def __init__(self, cfg, **kwargs):
         super().__init__()
@@ -45,6 +88,7 @@ class BCELossHead(LossHead):
             nn.Linear(sizes[-2], sizes[-1], bias=cfg.bias)
         ])
         self.linear = nn.Sequential(*layers)
+        self.scaling = cfg.scaling
         self.logit_scale = (
             nn.Parameter(torch.ones([]) * np.log(1 / 0.07)) if cfg.scaling else
             torch.ones([], requires_grad=False) * np.log(1 / 1)
@@ -58,22 +102,47 @@ class BCELossHead(LossHead):
         new_dict.update({key: state_dict[key]})
         self.load_state_dict(new_dict)
 
+    def scaled_logits(self, x1, logit_scale=None):
+        logits = self.linear(x1)
+        if self.scaling: # otherwise the scale is a constant exp(0) = 1
+            logit_scale = self.logit_scale.exp() if logit_scale is None else logit_scale
+            logits = logit_scale * logits
+        return logits
+
     def infer(self, x1, x2, *args, **kwargs):
         if not hasattr(self, "audios") or not hasattr(self, "x1s") or \
             not hasattr(self, "x2s") or not hasattr(self, "ids"): 
-            self.audios, self.x1s, self.x2s, self.ids = [], [], [], []
+            self.audios, self.ids = [], []
+            self.x1s = self.x2s = None # growing device buffers, see `collect`
+            self._nrow = 0
+            self._logit_scale = self.logit_scale.exp().detach() # fixed during evaluation
         self.audios.append(x1)
-        logit_scale = self.logit_scale.exp()
-        logits_per_x1 = logit_scale * self.linear(x1)
+        logits_per_x1 = self.scaled_logits(x1, self._logit_scale)
         loss_mean_x1 = self.loss_fn(logits_per_x1, x2.float())
         predictions = torch.sigmoid(logits_per_x1)
-        self.x1s.append(predictions)
-        self.x2s.append(x2)
+        self.collect(predictions, x2)
         names = kwargs.get("names", None)
         if names is not None:
             self.ids.extend(names)
         return loss_mean_x1
 
+    def collect(self, predictions, x2):
+        """ write the batch into device buffers that double their size when full,
+            so that `report` needs neither a concatenation nor per-batch copies.
+        """
+        nrow = self._nrow + predictions.shape[0]
+        if self.x1s is None or nrow > self.x1s.shape[0]:
+            size = max(nrow, 2 * (0 if self.x1s is None else self.x1s.shape[0]))
+            x1s = predictions.new_empty((size,) + predictions.shape[1:])
+            x2s = x2.new_empty((size,) + x2.shape[1:])
+            if self.x1s is not None:
+                x1s[:self._nrow] = self.x1s[:self._nrow]
+                x2s[:self._nrow] = self.x2s[:self._nrow]
+            self.x1s, self.x2s = x1s, x2s
+        self.x1s[self._nrow : nrow] = predictions
+        self.x2s[self._nrow : nrow] = x2
+        self._nrow = nrow
+
     def zero_shot(self, text, gold_file):
         audios = torch.cat(self.audios)
         if True and not self.normalized:
@@ -89,34 +158,43 @@ class BCELossHead(LossHead):
         if text is not None:
             return self.zero_shot(text, gold_file)
         # supervised classification
-        x1s = torch.cat(self.x1s).cpu().numpy() if x1s is None else x1s
-        x2s = torch.cat(self.x2s).cpu().numpy() if x2s is None else x2s
+        x1s = self.x1s[:self._nrow].cpu().numpy() if x1s is None else x1s
+        x2s = self.x2s[:self._nrow].cpu().numpy() if x2s is None else x2s
         nsample, nlabel = x1s.shape[:2]
         
         ap_micro = metrics.average_precision_score(x2s, x1s, average='micro')
         ap_macro = metrics.average_precision_score(x2s, x1s, average='macro')
         ap_weighted = metrics.average_precision_score(x2s, x1s, average='weighted')
 
-        # multi-label classification metrics
-        has_err = False
-        ap_list, auc_list, precisions, recalls = [], [], [], []
-        for k in range(nlabel): # unnecessary (from AST)
-            y_true, y_score = x2s[:, k], x1s[:, k]
-            ap = metrics.average_precision_score(y_true, y_score, average=None) 
-            if math.isnan(ap):
-                ap = 0.
-                has_err = True
-            try:
-                auc = metrics.roc_auc_score(y_true, y_score, average=None)
-            except Exception as e:
-                auc = 0. # auc may not be used a valid metric for this task
-                has_err = True
-            p, r, _ = metrics.precision_recall_curve(y_true, y_score)
-            mid = len(p) // 2
-            ap_list.append(ap)
-            auc_list.append(auc)
-            precisions.append(p[mid])
-            recalls.append(r[mid])
+        # multi-label classification metrics (per-label scores in a single call)
+        ap_list = metrics.average_precision_score(x2s, x1s, average=None)
+        has_err = bool(np.isnan(ap_list).any())
+        ap_list = np.nan_to_num(ap_list, nan=0.)
+        try:
+            auc_list = metrics.roc_auc_score(x2s, x1s, average=None)
+        except Exception as e: # some labels have no positive or no negative samples
+            has_err = True
+            auc_list = []
+            for k in range(nlabel):
+                try:
+                    auc = metrics.roc_auc_score(x2s[:, k], x1s[:, k])
+                except Exception as e:
+                    auc = 0. # auc may not be used a valid metric for this task
+                auc_list.append(auc)
+        has_err = has_err or bool(np.isnan(auc_list).any())
+        auc_list = np.nan_to_num(auc_list, nan=0.)
+        if njit is not None: # one jit-compiled sweep over all labels
+            precisions, recalls = _pr_midpoints(
+                np.ascontiguousarray(x2s.T, dtype=np.float64),
+                np.ascontiguousarray(x1s.T, dtype=np.float64),
+            )
+        else:
+            precisions, recalls = [], []
+            for k in range(nlabel): # sklearn does not batch `precision_recall_curve`
+                p, r, _ = metrics.precision_recall_curve(x2s[:, k], x1s[:, k])
+                mid = len(p) // 2
+                precisions.append(p[mid])
+                recalls.append(r[mid])
         mean_ap = np.mean(ap_list) * 100.
         mean_auc = np.mean(auc_list) * 100.
         mean_p = np.mean(precisions) * 100.
@@ -125,7 +203,7 @@ class BCELossHead(LossHead):
             f"Err({has_err}) mAP = {mean_ap:2.2f} mAUC = {mean_auc:2.2f} mP = {mean_p:2.2f} mR = {mean_r:2.2f}"
         )
 
-        del self.audios, self.x1s, self.x2s, self.ids
+        del self.audios, self.x1s, self.x2s, self.ids, self._logit_scale, self._nrow
         common = f"Mac-AP = {ap_macro:2.2f} Mic-AP = {ap_micro:2.2f} wAP = {ap_weighted:2.2f}"
         report = f"{common} {text} @ {nsample}" 
         return report
@@ -137,8 +215,7 @@ class BCELossHead(LossHead):
             if not dist.is_initialized() or dist.get_rank() == 0:
                 return self.infer(x1, x2, *args, **kwargs)
             return None 
-        logit_scale = self.logit_scale.exp()
-        logits_per_x1 = logit_scale * self.linear(x1)
+        logits_per_x1 = self.scaled_logits(x1)
         loss_mean_x1 = self.loss_fn(logits_per_x1, x2.float())
         return loss_mean_x1
 
@@ -168,16 +245,17 @@ class BCHingeLossHead(BCELossHead):
     def infer(self, x1, x2, *args, **kwargs):
         if not hasattr(self, "audios") or not hasattr(self, "x1s") or \
             not hasattr(self, "x2s") or not hasattr(self, "ids"):
-            self.audios, self.x1s, self.x2s, self.ids = [], [], [], []
+            self.audios, self.ids = [], []
+            self.x1s = self.x2s = None # growing device buffers, see `collect`
+            self._nrow = 0
+            self._logit_scale = self.logit_scale.exp().detach() # fixed during evaluation
         self.audios.append(x1)
-        logit_scale = self.logit_scale.exp()
-        logits_per_x1 = logit_scale * self.linear(x1)
+        logits_per_x1 = self.scaled_logits(x1, self._logit_scale)
         logits_per_x1 = torch.sigmoid(logits_per_x1)
         label = self.convert_label(x2)
         loss_mean_x1 = self.loss_fn(logits_per_x1, label)
         predictions = logits_per_x1 #torch.sigmoid(logits_per_x1)
-        self.x1s.append(predictions)
-        self.x2s.append(x2)
+        self.collect(predictions, x2)
         names = kwargs.get("names", None)
         if names is not None:
             self.ids.extend(names)
@@ -190,8 +268,7 @@ class BCHingeLossHead(BCELossHead):
             if not dist.is_initialized() or dist.get_rank() == 0:
                 return self.infer(x1, x2, *args, **kwargs)
             return None
-        logit_scale = self.logit_scale.exp()
-        logits_per_x1 = logit_scale * self.linear(x1)
+        logits_per_x1 = self.scaled_logits(x1)
         logits_per_x1 = torch.sigmoid(logits_per_x1)
         label = self.convert_label(x2)
         loss_mean_x1 = self.loss_fn(logits_per_x1, label)
@@ -1,13 +1,19 @@
 from collections import OrderedDict
 from typing import Tuple, Union
 
+import math
+import inspect
 import numpy as np
 import torch
 import torch.nn.functional as F
 from torch import nn
+from torch.utils.checkpoint import checkpoint
 
 from clip import LayerNorm, QuickGELU
 
+# the non-reentrant variant (torch >= 1.11) also works when the inputs do not require grad
+CHECKPOINT_KWARGS = {"use_reentrant": False} if "use_reentrant" in inspect.signature(checkpoint).parameters else {}
+
 class ResidualAttentionBlock(nn.Module):
     def __init__(self, d_model: int, n_head: int, attn_mask: torch.Tensor = None):
         super().__init__()
@@ -85,7 +91,26 @@ class Transformer(nn.Module):
             #ResidualAttentionBlock(width, heads, attn_mask) for _ in range(layers)
             GeneralResidualAttentionBlock(width, heads, attn_mask, require_inter_attn) for _ in range(layers)
         ])
+        self.grad_ckpt = False # activation checkpointing
+        self.grad_ckpt_segments = 4
+
+    def forward_ckpt(self, x: torch.Tensor, memory: torch.Tensor=None):
+        """ only keep the activations at the boundaries of the segments and recompute the others.
+        """
+        def run_segment(start, end):
+            def forward(x, memory):
+                for block in self.resblocks[start : end]:
+                    x, memory = block((x, memory))
+                return x
+            return forward
+        nblock = len(self.resblocks)
+        size = math.ceil(nblock / self.grad_ckpt_segments)
+        for start in range(0, nblock, size):
+            x = checkpoint(run_segment(start, start + size), x, memory, **CHECKPOINT_KWARGS)
+        return x
 
     def forward(self, x: torch.Tensor, memory: torch.Tensor=None):
+        if self.grad_ckpt and self.training and torch.is_grad_enabled():
+            return self.forward_ckpt(x, memory)
         #return self.resblocks(x)
         return self.resblocks((x, memory))[0]
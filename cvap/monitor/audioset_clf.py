@@ -14,7 +14,7 @@ from torch.nn.parallel import data_parallel
 from torch.nn.parallel import DistributedDataParallel
 from torch.optim.lr_scheduler import CosineAnnealingWarmRestarts, MultiStepLR
 
-from ..util import numel, AverageMeter
+from ..util import numel, AverageMeter, build_ddp, multi_tensor_kwargs
 from ..model import extract_model_file
 from ..model import ASClassifier as Model
 from ..module import LARS, exclude_bias_or_norm, adjust_learning_rate
@@ -38,9 +38,7 @@ class Monitor(object):
             self.model.train(not cfg.eval)
             return #
         tunable_params = model.build(**{"output_dim": output_dim})
-        self.model = DistributedDataParallel(
-            model, device_ids=[cfg.rank], find_unused_parameters=True
-        ) if torch.distributed.is_initialized() else model 
+        self.model = build_ddp(cfg, model) if torch.distributed.is_initialized() else model 
         self.model.train(not cfg.eval)
         self.build_optimizer(tunable_params)
 
@@ -456,7 +454,9 @@ class Monitor(object):
         else:
             ocfg = self.cfg.optimizer.optimizer
             scfg = self.cfg.optimizer.scheduler
-            self.optimizer = getattr(torch.optim, ocfg[0])(param_groups, **ocfg[1])
+            optimizer_cls = getattr(torch.optim, ocfg[0])
+            kwargs = {**multi_tensor_kwargs(self.cfg, optimizer_cls, ocfg[1]), **ocfg[1]}
+            self.optimizer = optimizer_cls(param_groups, **kwargs)
             self.scheduler = getattr(torch.optim.lr_scheduler, scfg[0])(self.optimizer, **scfg[1])
         if not self.cfg.verbose:
             return
@@ -1,5 +1,5 @@
 from omegaconf import OmegaConf
-import os, re
+import os, re, contextlib
 from collections import defaultdict
 
 import time
@@ -18,29 +18,30 @@ from ..module import adjust_learning_rate
 
 class Monitor(Monitor):
     def __init__(self, cfg, echo, device):
+        # bf16 has the exponent range of fp32 and thus needs no loss scaling
+        self.use_bf16 = hasattr(torch, "autocast") and torch.cuda.is_bf16_supported()
         super(Monitor, self).__init__(cfg, echo, device)
 
+    def autocast(self):
+        if self.use_bf16:
+            return torch.autocast(device_type="cuda", dtype=torch.bfloat16)
+        return torch.cuda.amp.autocast()
+
     def eval_norms(self):
         self.echo("Evaluate mean and std...")
-        cnt = 0.
-        som = torch.tensor(0., device=self.device)
-        sos = torch.tensor(0., device=self.device)
-        som_list, sos_list = list(), list()
+        cnt = 0 # Welford's online algorithm (merging per-batch statistics)
+        som = torch.zeros(1, device=self.device)
+        m2 = torch.zeros(1, device=self.device)
         for step, batch in enumerate(self.dataloader):
             audios, _, _ = self.make_batch(batch)
-            bsz = audios.shape[0]
-            new_cnt = cnt + bsz
-            mean = audios.mean(axis=[2, 3])
-            mean_sq = (audios ** 2).mean(axis=[2, 3])
-            """ incremental update might be numerically unstable
-            som = (som * cnt + mean.sum()) / new_cnt
-            sos = (sos * cnt + mean_sq.sum()) / new_cnt
-            """
-            som_list.append(mean)
-            sos_list.append(mean_sq)
-        som = torch.cat(som_list, 0).mean(axis=[0])
-        sos = torch.cat(sos_list, 0).mean(axis=[0])
-        std = (sos - som ** 2).sqrt()
+            n = audios.numel() // audios.shape[1]
+            var, mean = torch.var_mean(audios, dim=[0, 2, 3], unbiased=False) # a single pass
+            new_cnt = cnt + n
+            delta = mean - som
+            som = som + delta * n / new_cnt
+            m2 = m2 + var * n + delta ** 2 * cnt * n / new_cnt
+            cnt = new_cnt
+        std = (m2 / cnt).sqrt()
         self.echo(f"MEAN: {som.cpu().tolist()} STD: {std.cpu().tolist()}")
 
     def encode_text(self):
@@ -60,19 +61,18 @@ class Monitor(Monitor):
                 )
         self.echo(f"Encode caption ({len(self.dataloader)} batches)...to `{audio_root}`")
         nsample = 0
-        start_time = time.time()
-        device_ids = [i for i in range(self.cfg.num_gpus)]
+        start_time = time.perf_counter()
         for step, batch in enumerate(self.dataloader):
             _, text, names = self.make_batch(batch)
 
-            text_features = self.model.encode_text(text, device_ids=device_ids)
+            text_features = self.model.encode_text(text, device_ids=self.device_ids)
             text_features = text_features.cpu().numpy()
 
             save_npz(names, text=text_features)
 
             nsample += text.shape[0]
             if (step + 1) % rcfg.peep_rate == 0:
-                self.echo(f"--step {step + 1:08d} {nsample / (time.time() - start_time):.2f} samples/s")
+                self.echo(f"--step {step + 1:08d} {nsample / (time.perf_counter() - start_time):.2f} samples/s")
         self.echo(f"Saving {nsample} text vectors.")
 
     def build_data(self):
@@ -95,7 +95,7 @@ class Monitor(Monitor):
         # evaluation
         eval_name = "IGNORE_ME" if self.cfg.eval else rcfg.eval_name
         data_path = f"{rcfg.data_root}/{eval_name}"
-        do_eval = os.path.isdir(data_path) or os.path.isfile(f"{data_path}.csv") #or tf.io.gfile.exists(f"{data_path}.csv")
+        do_eval = os.path.isdir(data_path) or os.path.isfile(f"{data_path}.csv")
         _, self.evalloader = build_dataloader(
             self.cfg, eval_name, shuffle=False, train=False
         ) if do_eval else (None, None)
@@ -105,7 +105,7 @@ class Monitor(Monitor):
         # test
         test_name = "IGNORE_ME" if self.cfg.eval else rcfg.test_name
         data_path = f"{rcfg.data_root}/{test_name}"
-        do_eval = os.path.isdir(data_path) or os.path.isfile(f"{data_path}.csv") #or tf.io.gfile.exists(f"{data_path}.csv")
+        do_eval = os.path.isdir(data_path) or os.path.isfile(f"{data_path}.csv")
         _, self.testloader = build_dataloader(
             self.cfg, test_name, shuffle=False, train=False,
         ) if do_eval else (None, None)
@@ -114,6 +114,8 @@ class Monitor(Monitor):
             self.gold_file_test = f"{rcfg.data_root}/{test_name}.csv"
 
     def learn(self):
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
         if self.cfg.running.audio.eval_norms:
             return # `eval_norms` is the only task
         if not self.model.training:
@@ -133,11 +135,12 @@ class Monitor(Monitor):
             return None
         self.echo("Training started...")
         self.last_time = 0.
-        self.total_loss = 0
+        self.total_loss = torch.zeros((), device=self.device) # synced only when reporting
+        self.gnorm = None # gradient norm, tracked when verbose
         self.total_step = 0
         self.total_inst = 0
-        self.start_time = time.time()
-        self.scaler = torch.cuda.amp.GradScaler()
+        self.start_time = time.perf_counter()
+        self.scaler = None if self.use_bf16 else torch.cuda.amp.GradScaler()
         #self.save() 
         for iepoch in range(self.cfg.optimizer.epochs):
             if isinstance(self.model, DistributedDataParallel):
@@ -145,6 +148,7 @@ class Monitor(Monitor):
             if iepoch >= 1:
                 pass #break
             self.epoch(iepoch)
+        self.wait_for_save()
 
     def make_batch(self, batch):
         if len(batch) > 3: # needed when using `AudioCapDatasetSrc`
@@ -157,86 +161,102 @@ class Monitor(Monitor):
                 ), # captions / label
                 batch[4], # captions / label name
             )
-        elif len(batch) == 3:
+        elif len(batch) == 3: # pinned CPU tensors from the collator
             batch = (
-                torch.tensor(
-                    batch[0], device=self.device
+                batch[0].to(
+                    self.device, non_blocking=True
                 ).unsqueeze(1) if len(batch[0].shape) == 3 else (
-                    torch.tensor(batch[0], device=self.device)
+                    batch[0].to(self.device, non_blocking=True)
                 ), # audio
-                torch.tensor(
-                    batch[1], device=self.device
+                batch[1].to(
+                    self.device, non_blocking=True
                 ), # captions / label
                 batch[2], # captions / label name
             )
         else:
             raise ValueError(f"I do not know how to parse `batch` (w/ {len(batch)} items).")
+        if getattr(self.cfg.running, "channels_last", False) and batch[0].dim() == 4:
+            batch = (batch[0].contiguous(memory_format=torch.channels_last),) + batch[1:]
         return batch # bare tensors
 
     def epoch(self, iepoch):
-        all_time = defaultdict(list)
-        self.timeit(all_time)        
-        device_ids = [i for i in range(self.cfg.num_gpus)]
+        all_time = defaultdict(lambda: [0., 0]) # running (sum, count) per key
+        self._timeit(all_time)        
         nchunk = dist.get_world_size() if torch.distributed.is_initialized() else 1  
         warmup_step_rate = max(self.cfg.optimizer.warmup_steps // 20, 1)
+        accum_steps = self.cfg.optimizer.accum_steps # virtual batch size = accum_steps x batch size
         for step, batch in enumerate(self.dataloader, start=iepoch * len(self.dataloader)):
             audios, text, _ = self.make_batch(batch)
-            self.timeit(all_time, key="data")
+            self._timeit(all_time, key="data")
 
             if self.cfg.optimizer.use_lars:
                 adjust_learning_rate(self.cfg.optimizer, self.optimizer, self.dataloader, step)
 
+            # skip gradient all-reduce until the last micro-batch of the virtual batch
+            do_step = (self.total_step + 1) % accum_steps == 0
+            nupdate = self.total_step // accum_steps # warmup and lr schedules count optimizer updates
+
             inc = 0
             force_eval = False # recommended by SGDR
-            warmup = not self.cfg.optimizer.use_lars and self.cfg.optimizer.warmup and \
-                (self.total_step + inc) <= self.cfg.optimizer.warmup_steps
+            warmup = self._do_warmup and (nupdate + inc) <= self.cfg.optimizer.warmup_steps
             # it is important to always warm up lr at the first step otherwise
             # the optimizer will use the default / initial lr
-            if warmup and ((self.total_step + inc) % warmup_step_rate == 0 or self.total_step == 0):
-                ratio = ((self.total_step + inc) / self.cfg.optimizer.warmup_steps) # * self.cfg.optimizer.lr
-                for param_group in self.optimizer.param_groups:
-                    param_group['lr'] = ratio * param_group["initial_lr"]
+            if do_step and warmup and ((nupdate + inc) % warmup_step_rate == 0 or nupdate == 0):
+                for param_group, delta in zip(self.optimizer.param_groups, self._warmup_delta):
+                    param_group['lr'] = (nupdate + inc) * delta
                 lrs = [param_group['lr'] for param_group in self.optimizer.param_groups]
-                force_eval = lrs == self.scheduler.base_lrs
+                force_eval = (nupdate + inc) == self.cfg.optimizer.warmup_steps # lr reaches base lr
                 lrs = [f"{lr:.2e}" for lr in lrs]
                 self.echo(f"warmup lr: {' '.join(lrs)} @ {self.total_step}")
 
-            self.optimizer.zero_grad(set_to_none=True)
-            with torch.cuda.amp.autocast():
-                loss = self.model(audios, text, device_ids=device_ids, retrieval=self.cfg.running.retrieval)
-            self.scaler.scale(loss).backward()
-            self.scaler.step(self.optimizer)
-            self.scaler.update()
+            sync_ctx = (
+                self.model.no_sync() if not do_step and isinstance(self.model, DistributedDataParallel)
+                else contextlib.nullcontext()
+            )
+            with sync_ctx:
+                with self.autocast():
+                    loss = self.model(audios, text, device_ids=self.device_ids, retrieval=self.cfg.running.retrieval)
+                if self.scaler is not None:
+                    self.scaler.scale(loss / accum_steps).backward()
+                else:
+                    (loss / accum_steps).backward()
+            if do_step:
+                peep = force_eval or (self.total_step + 1) % self.cfg.running.peep_rate == 0
+                if self.cfg.verbose and peep and not self.step_in_backward: # only on the steps that report it
+                    if self.scaler is not None:
+                        self.scaler.unscale_(self.optimizer)
+                    self.gnorm = self.grad_norm()
+                if self.scaler is not None:
+                    self.scaler.step(self.optimizer)
+                    self.scaler.update()
+                elif not self.step_in_backward: # otherwise done in the grad hooks
+                    self.optimizer.step()
+                self.optimizer.zero_grad(set_to_none=True)
 
-            if not self.cfg.optimizer.use_lars and self.cfg.optimizer.batch_sch and not warmup:
+            if do_step and self._do_batch_sch and not warmup:
                 old_lrs = " ".join([f"{x:.2e}" for x in self.scheduler.get_last_lr()])
                 self.scheduler.step() # after all warmup is completed
                 if isinstance(self.scheduler, (CosineAnnealingWarmRestarts,)):
                     force_eval = self.scheduler.get_last_lr() == self.scheduler.base_lrs
                 #self.echo(f"do step lr {old_lrs}")
 
-            self.timeit(all_time, key="model")
-
-            if False and self.cfg.rank == 0:
-                print(f"doing some check on unused params... {dist.get_world_size()}")
-                for k, v in self.model.named_parameters():
-                    if v.requires_grad and v.grad is None:
-                        print(f"--> {k}")
+            self._timeit(all_time, key="model")
 
             self.total_step += 1
-            self.total_loss += loss.detach()
+            self.total_loss.add_(loss.detach())
             self.total_inst += audios.shape[0] * nchunk
             if force_eval or (self.cfg.rank == 0 and self.total_step % self.cfg.running.peep_rate == 0):
-                def grad_norm():
-                    return sum(
-                        [p.grad.norm(p=2) ** 2 for p in self.params if p.grad is not None]
-                    ).item() ** 0.5
                 lr_w = self.optimizer.param_groups[0]['lr']
                 lr_b = self.optimizer.param_groups[1]['lr']
+                scalars = [self.total_loss / self.total_step] + ([] if self.gnorm is None else [self.gnorm])
+                scalars = torch.stack([x.float() for x in scalars]).tolist() # the only sync
+                loss_val = scalars[0]
+                gnorm = f"gnorm {scalars[1]:.2f} " if len(scalars) > 1 else ""
+                self.gnorm = None # reported once; lines off the update steps carry no gnorm
                 self.echo(
-                    f"epoch {iepoch:>4} step {self.total_step}\t" + #gnorm {grad_norm():.2f} " +
-                    f"lr_w {lr_w:.2e} lr_b {lr_b:.2e} loss {self.total_loss / self.total_step:.3f} " + 
-                    f"{self.total_inst / (time.time() - self.start_time):.2f} samples/s"
+                    f"epoch {iepoch:>4} step {self.total_step}\t{gnorm}" +
+                    f"lr_w {lr_w:.2e} lr_b {lr_b:.2e} loss {loss_val:.3f} " + 
+                    f"{self.total_inst / (time.perf_counter() - self.start_time):.2f} samples/s"
                 )
             if force_eval or self.total_step % self.cfg.running.save_rate == 0 or (
                     self.cfg.running.save_epoch and self.total_step % len(self.dataloader) == 0
@@ -265,20 +285,23 @@ class Monitor(Monitor):
 
                 if self.cfg.rank == 0:
                     self.save()
-            self.timeit(all_time, key="report")
+            self._timeit(all_time, key="report")
 
         if not self.cfg.optimizer.use_lars:
             self.scheduler.step()
-        self.timeit(all_time, show=True)
+        self._timeit(all_time, show=True)
         
     def infer(self, dataloader, samples=float("inf"), iepoch=0):
-        losses, nsample, nchunk, nbatch = 0, 0, 1, len(dataloader)
-        device_ids = [i for i in range(self.cfg.num_gpus)]
+        if samples <= 0: # nothing would be collected for the report
+            return ""
+        # `loss or 0.` would sync on every batch; keep the sum on device instead
+        losses = torch.zeros((), device=self.device)
+        nsample, nchunk, nbatch = 0, 1, len(dataloader)
         if isinstance(self.model, DistributedDataParallel):
             dataloader.sampler.set_epoch(iepoch)
             nchunk = self.cfg.num_gpus
         peep_rate = max(10, (len(dataloader) // 10))
-        start_time = time.time()
+        start_time = time.perf_counter()
         for ibatch, batch in enumerate(dataloader):
             if nsample >= samples:
                 #print(f"{nsample}\t{ibatch}/{nbatch} continue")
@@ -286,19 +309,53 @@ class Monitor(Monitor):
             audios, text, names = self.make_batch(batch)
             #msg = f"{audios[0, 0, 50, 50:55]} {text[0, 50, 50:55]}" # if ibatch == 0 else ""
             #print(f"{nsample}\t{ibatch}/{nbatch} done {msg}")
-            loss = self.model(audios, text, device_ids=device_ids, names=names, retrieval=self.cfg.running.retrieval)
+            # fp32 (no autocast) so that R@k and eval losses stay comparable across checkpoints
+            loss = self.model(audios, text, device_ids=self.device_ids, names=names, retrieval=self.cfg.running.retrieval)
             nsample += audios.shape[0] * nchunk
-            losses += loss or 0.
+            if loss is not None: # None on non-zero ranks
+                losses += loss.detach() if torch.is_tensor(loss) else loss
             if self.cfg.rank == 0 and (ibatch + 1) % peep_rate == 0:
                 self.echo(
                     f"step {ibatch}\t" + #gnorm {grad_norm():.2f} " +
-                    f"loss {losses / (ibatch + 1):.8f} " +
-                    f"{nsample / (time.time() - start_time):.2f} samples/s"
+                    f"loss {losses.item() / (ibatch + 1):.8f} " +
+                    f"{nsample / (time.perf_counter() - start_time):.2f} samples/s"
                 )
         model = self.model.module if isinstance(self.model, DistributedDataParallel) else self.model
-        self.echo(f"# sample {nsample}; {nsample / (time.time() - start_time):.2f} samples/s")
+        self.echo(f"# sample {nsample}; {nsample / (time.perf_counter() - start_time):.2f} samples/s")
         return model.report(gold_file=self.gold_file)
 
+    def build_optimizer(self, tunable_params={}):
+        """ optionally step a per-parameter optimizer as soon as the gradient of the parameter
+            is accumulated, so that the full set of gradients is never materialized at once.
+        """
+        self.step_in_backward = False
+        super(Monitor, self).build_optimizer(tunable_params)
+        if not self.model.training or not self.cfg.optimizer.step_in_backward:
+            return
+        if self.cfg.optimizer.use_lars or not self.use_bf16 or self.cfg.optimizer.accum_steps > 1 or \
+            isinstance(self.model, DistributedDataParallel) or \
+            not hasattr(torch.Tensor, "register_post_accumulate_grad_hook"):
+            self.echo(
+                "Cannot step the optimizer in backward " +
+                "(requires torch>=2.1, bf16, and no DDP / LARS / gradient accumulation)."
+            )
+            return
+        ocfg = self.cfg.optimizer.optimizer
+        optimizers = dict()
+        def make_hook(param_group):
+            def hook(p): # lr is still scheduled via `self.optimizer`
+                optimizer = optimizers[p]
+                optimizer.param_groups[0]["lr"] = param_group["lr"]
+                optimizer.step()
+                optimizer.zero_grad(set_to_none=True)
+            return hook
+        for param_group in self.optimizer.param_groups:
+            for p in param_group["params"]:
+                optimizers[p] = getattr(torch.optim, ocfg[0])([p], **ocfg[1])
+                p.register_post_accumulate_grad_hook(make_hook(param_group))
+        self.step_in_backward = True
+        self.echo(f"Step {len(optimizers)} per-parameter optimizers in backward.")
+
     def repeated_retrieval(self):
         self.echo("Evaluate multiple checkpoints.")
         model_files = extract_model_file(self.cfg, self.echo)
@@ -13,7 +13,7 @@ import torch.nn.functional as F
 from torch.nn.parallel import data_parallel
 from torch.nn.parallel import DistributedDataParallel
 
-from ..util import numel
+from ..util import numel, build_ddp, multi_tensor_kwargs
 from ..model import CVALP as Model
 from ..module import LARS, exclude_bias_or_norm, adjust_learning_rate
 from ..data import build_audioset_dataloader as build_dataloader
@@ -32,9 +32,7 @@ class Monitor(object):
             return # mean & std of the data
         model = Model(cfg, echo)
         tunable_params = model.build(**{"output_dim": output_dim})
-        self.model = DistributedDataParallel(
-            model, device_ids=[cfg.rank], find_unused_parameters=True
-        ) if torch.distributed.is_initialized() else model 
+        self.model = build_ddp(cfg, model) if torch.distributed.is_initialized() else model 
         self.model.train(not cfg.eval)
         self.build_optimizer(tunable_params)
 
@@ -338,7 +336,9 @@ class Monitor(object):
         else:
             ocfg = self.cfg.optimizer.optimizer
             scfg = self.cfg.optimizer.scheduler
-            self.optimizer = getattr(torch.optim, ocfg[0])(param_groups, **ocfg[1])
+            optimizer_cls = getattr(torch.optim, ocfg[0])
+            kwargs = {**multi_tensor_kwargs(self.cfg, optimizer_cls, ocfg[1]), **ocfg[1]}
+            self.optimizer = optimizer_cls(param_groups, **kwargs)
             self.scheduler = getattr(torch.optim.lr_scheduler, scfg[0])(self.optimizer, **scfg[1])
         if not self.cfg.verbose:
             return
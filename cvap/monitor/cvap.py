@@ -1,10 +1,10 @@
 from omegaconf import OmegaConf
-import os, re
+import os, contextlib
+import concurrent.futures
 from collections import defaultdict
 
 import time
 import torch
-import numpy as np
 from torch import nn
 
 import torch.distributed as dist
@@ -13,10 +13,11 @@ from torch.nn.parallel import data_parallel
 from torch.nn.parallel import DistributedDataParallel
 from torch.optim.lr_scheduler import CosineAnnealingWarmRestarts
 
-from ..util import numel
+from ..util import numel, build_ddp, multi_tensor_kwargs
 from ..model import build_main_model, extract_model_file
 from ..module import LARS, exclude_bias_or_norm, adjust_learning_rate
 from ..data import build_image_audio_dataloader as build_dataloader 
+from ..data import BackgroundPrefetcher, CUDAPrefetcher
 
 class Monitor(object):
     def __init__(self, cfg, echo, device):
@@ -24,6 +25,11 @@ class Monitor(object):
         self.cfg = cfg
         self.echo = echo
         self.device = device
+        # DDP runs one process per gpu and thus needs no `data_parallel` replicas
+        self.device_ids = None if torch.distributed.is_initialized() else tuple(range(cfg.num_gpus))
+        self._timeit = self.timeit if cfg.rank == 0 else (lambda *args, **kwargs: None)
+        self._saver = concurrent.futures.ThreadPoolExecutor(max_workers=1) # checkpoint writer
+        self._save_future = None
         self.build_data()
         if self.cfg.running.audio.eval_norms:
             self.eval_norms()
@@ -34,33 +40,33 @@ class Monitor(object):
             self.model.train(not cfg.eval)
             return #
         tunable_params = model.build()
-        self.model = DistributedDataParallel(
-            model, device_ids=[cfg.rank], find_unused_parameters=True
+        if getattr(cfg.running, "channels_last", False): # NHWC conv kernels
+            model = model.to(memory_format=torch.channels_last)
+        self._uncompiled = model # state dicts w/o the `_orig_mod.` prefix
+        if not cfg.eval and getattr(cfg.running, "compile", False) and hasattr(torch, "compile"):
+            model = torch.compile(model, mode="max-autotune", fullgraph=False)
+        self.model = build_ddp( # larger buckets -> fewer all-reduce calls; no per-step buffer broadcast
+            cfg, model, bucket_cap_mb=100, broadcast_buffers=False
         ) if torch.distributed.is_initialized() else model 
         self.model.train(not cfg.eval)
         self.build_optimizer(tunable_params)
 
     def eval_norms(self):
         self.echo("Evaluate mean and std...")
-        cnt = 0.
-        som = torch.tensor(0., device=self.device)
-        sos = torch.tensor(0., device=self.device)
-        som_list, sos_list = list(), list()
+        cnt = 0 # running sums in float64 take O(C) memory regardless of the data size
+        som = sos = None
         for step, batch in enumerate(self.dataloader):
             _, audios, _ = self.make_batch(batch)
-            bsz = audios.shape[0]
-            new_cnt = cnt + bsz
-            mean = audios.mean(axis=[2, 3])
-            mean_sq = (audios ** 2).mean(axis=[2, 3])
-            """ incremental update might be numerically unstable
-            som = (som * cnt + mean.sum()) / new_cnt
-            sos = (sos * cnt + mean_sq.sum()) / new_cnt
-            """
-            som_list.append(mean)
-            sos_list.append(mean_sq)
+            var, mean = torch.var_mean(audios, dim=[2, 3], unbiased=False) # a single pass
+            var, mean = var.double(), mean.double() # only the small (B, C) stats are upcast
+            mean_sq = (var + mean ** 2).sum(0)
+            mean = mean.sum(0)
+            som = mean if som is None else som + mean
+            sos = mean_sq if sos is None else sos + mean_sq
+            cnt += audios.shape[0]
             self.echo(f"step {step}")
-        som = torch.cat(som_list, 0).mean(axis=[0])
-        sos = torch.cat(sos_list, 0).mean(axis=[0])
+        som = som / cnt
+        sos = sos / cnt
         std = (sos - som ** 2).sqrt()
         self.echo(f"MEAN: {som.cpu().tolist()} STD: {std.cpu().tolist()}")
 
@@ -78,7 +84,7 @@ class Monitor(object):
         # evaluation
         eval_name = "IGNORE_ME" if self.cfg.eval else rcfg.eval_name
         data_path = f"{rcfg.data_root}/{eval_name}"
-        do_eval = os.path.isdir(data_path) or os.path.isfile(f"{data_path}.csv") #or tf.io.gfile.exists(f"{data_path}.csv")
+        do_eval = os.path.isdir(data_path) or os.path.isfile(f"{data_path}.csv")
         _, self.evalloader = build_dataloader(
             self.cfg, eval_name, shuffle=False, train=False
         ) if do_eval else (None, None)
@@ -97,10 +103,11 @@ class Monitor(object):
                 return None 
         self.echo("Training started...")
         self.last_time = 0.
-        self.total_loss = 0
+        self.total_loss = torch.zeros((), device=self.device) # synced only when reporting
+        self.gnorm = None # gradient norm, tracked when verbose
         self.total_step = 0
         self.total_inst = 0
-        self.start_time = time.time()
+        self.start_time = time.perf_counter()
         self.scaler = torch.cuda.amp.GradScaler()
         #self.save() 
         for iepoch in range(self.cfg.optimizer.epochs):
@@ -109,15 +116,17 @@ class Monitor(object):
             if iepoch >= 1:
                 pass #break
             self.epoch(iepoch)
+        self.wait_for_save()
 
     def make_batch(self, batch):
-        images = torch.tensor(batch[0], device=self.device) # (c, h, w)
-        audios = torch.tensor(batch[1], device=self.device).unsqueeze(1)
+        images = batch[0].to(self.device, non_blocking=True) # (c, h, w)
+        audios = batch[1].to(self.device, non_blocking=True) # (b, 1, h, w)
         #print(images.shape, self.cfg.running.resolution)
-        if images.dim() != 2 and images.shape[-1] != self.cfg.running.resolution:
+        resolution = self.cfg.running.resolution # pre-resized images skip the interpolation
+        if images.dim() != 2 and (images.shape[-1] != resolution or images.shape[-2] != resolution):
             images = F.interpolate(
                 images,
-                self.cfg.running.resolution,
+                resolution,
                 mode="bilinear",
                 align_corners=False,
             )
@@ -126,101 +135,112 @@ class Monitor(object):
         )
         return batch # bare tensors
 
-        images, audios = batch["image"], batch["audio"]
-
-        images = images.cuda(self.cfg.rank, non_blocking=True)
-        audios = audios.cuda(self.cfg.rank, non_blocking=True)
-        return images, audios # directly return dict of tensors
-
-        images = torch.tensor(
-            np.concatenate(images, axis=0), device=self.device
-        ) #.cuda(self.cfg.rank, non_blocking=True)
-        audios = torch.tensor(
-            np.concatenate(audios, axis=0), device=self.device
-        ).unsqueeze(1) #.cuda(self.cfg.rank, non_blocking=True)
-        #print(f"make_batch {dist.get_rank()} {batch['name']}")
-        return images, audios
-
     def timeit(self, time_dict, key=None, show=False):
         if self.cfg.rank != 0:
             return 
         if show: # print
             report = ""
-            for k, v in time_dict.items():
-                report += f"{k} {np.mean(v):.2f} "
+            for k, (total, count) in time_dict.items():
+                report += f"{k} {total / max(count, 1):.2f} "
             self.echo(f"Time (s): {report.strip()}; # step {self.total_step} # sample {self.total_inst}")
             return
         if key is None: # initialize
-            self.last_time = time.time()
+            self.last_time = time.perf_counter()
         else: # update
-            this_time = time.time()
-            time_dict[key].append(this_time - self.last_time)
+            this_time = time.perf_counter()
+            record = time_dict[key] # O(1) memory however long the epoch is
+            record[0] += this_time - self.last_time
+            record[1] += 1
             self.last_time = this_time
 
+    def grad_norm(self):
+        grads = [p.grad for p in self._trainable if p.grad is not None]
+        if len(grads) == 0:
+            return torch.zeros((), device=self.device)
+        if hasattr(torch, "_foreach_norm"): # a single multi-tensor kernel
+            norms = torch._foreach_norm(grads, 2.)
+        else:
+            norms = [grad.norm(p=2) for grad in grads]
+        norms = torch.stack(norms)
+        if hasattr(torch, "linalg") and hasattr(torch.linalg, "vector_norm"): # torch >= 1.9
+            return torch.linalg.vector_norm(norms) # stays on device until printed
+        return norms.norm(p=2)
+
     def epoch(self, iepoch):
-        all_time = defaultdict(list)
-        self.timeit(all_time)        
-        device_ids = [i for i in range(self.cfg.num_gpus)]
+        all_time = defaultdict(lambda: [0., 0]) # running (sum, count) per key
+        self._timeit(all_time)        
         nchunk = dist.get_world_size() if torch.distributed.is_initialized() else 1  
         warmup_step_rate = max(self.cfg.optimizer.warmup_steps // 20, 1)
-        for step, batch in enumerate(self.dataloader, start=iepoch * len(self.dataloader)):
+        depth = getattr(self.cfg.running, "prefetch", 0)
+        dataloader = BackgroundPrefetcher(self.dataloader, depth) if depth > 0 else self.dataloader
+        if getattr(self.cfg.running, "cuda_prefetch", False): # overlap H2D copies with compute
+            dataloader = CUDAPrefetcher(dataloader, self.device)
+        accum_steps = self.cfg.optimizer.accum_steps # virtual batch size = accum_steps x batch size
+        for step, batch in enumerate(dataloader, start=iepoch * len(self.dataloader)):
             images, audios, _ = self.make_batch(batch)
-            self.timeit(all_time, key="data")
+            self._timeit(all_time, key="data")
 
             if self.cfg.optimizer.use_lars:
                 adjust_learning_rate(self.cfg.optimizer, self.optimizer, self.dataloader, step)
 
+            # skip gradient all-reduce until the last micro-batch of the virtual batch
+            do_step = (self.total_step + 1) % accum_steps == 0
+            nupdate = self.total_step // accum_steps # warmup and lr schedules count optimizer updates
+
             inc = 0
             force_eval = False # recommended by SGDR
-            warmup = not self.cfg.optimizer.use_lars and self.cfg.optimizer.warmup and \
-                (self.total_step + inc) <= self.cfg.optimizer.warmup_steps
+            warmup = self._do_warmup and (nupdate + inc) <= self.cfg.optimizer.warmup_steps
             # it is important to always warm up lr at the first step otherwise
             # the optimizer will use the default / initial lr
-            if warmup and ((self.total_step + inc) % warmup_step_rate == 0 or self.total_step == 0):
-                ratio = ((self.total_step + inc) / self.cfg.optimizer.warmup_steps) # * self.cfg.optimizer.lr
-                for param_group in self.optimizer.param_groups:
-                    param_group['lr'] = ratio * param_group["initial_lr"]
+            if do_step and warmup and ((nupdate + inc) % warmup_step_rate == 0 or nupdate == 0):
+                for param_group, delta in zip(self.optimizer.param_groups, self._warmup_delta):
+                    param_group['lr'] = (nupdate + inc) * delta
                 lrs = [param_group['lr'] for param_group in self.optimizer.param_groups]
-                force_eval = lrs == self.scheduler.base_lrs
+                force_eval = (nupdate + inc) == self.cfg.optimizer.warmup_steps # lr reaches base lr
                 lrs = [f"{lr:.2e}" for lr in lrs]
                 self.echo(f"warmup lr: {' '.join(lrs)} @ {self.total_step}")
 
-            self.optimizer.zero_grad(set_to_none=True)
-            with torch.cuda.amp.autocast():
-                loss = self.model(images, audios, None, device_ids=device_ids)
-            self.scaler.scale(loss).backward()
-            self.scaler.step(self.optimizer)
-            self.scaler.update()
+            sync_ctx = (
+                self.model.no_sync() if not do_step and isinstance(self.model, DistributedDataParallel)
+                else contextlib.nullcontext()
+            )
+            with sync_ctx:
+                with torch.cuda.amp.autocast():
+                    loss = self.model(images, audios, None, device_ids=self.device_ids)
+                self.scaler.scale(loss / accum_steps).backward()
+            if do_step:
+                # norm of the unscaled gradients, only on the steps that report it
+                if self.cfg.verbose and (force_eval or (self.total_step + 1) % self.cfg.running.peep_rate == 0):
+                    self.scaler.unscale_(self.optimizer)
+                    self.gnorm = self.grad_norm()
+                self.scaler.step(self.optimizer)
+                self.scaler.update()
+                self.optimizer.zero_grad(set_to_none=True)
 
-            if not self.cfg.optimizer.use_lars and self.cfg.optimizer.batch_sch and not warmup:
+            if do_step and self._do_batch_sch and not warmup:
                 old_lrs = " ".join([f"{x:.2e}" for x in self.scheduler.get_last_lr()])
                 self.scheduler.step() # after all warmup is completed
                 if isinstance(self.scheduler, (CosineAnnealingWarmRestarts,)):
                     force_eval = self.scheduler.get_last_lr() == self.scheduler.base_lrs
                 #self.echo(f"do step lr {old_lrs}")
 
-            self.timeit(all_time, key="model")
-
-            if False and self.cfg.rank == 0:
-                print(f"doing some check on unused params... {dist.get_world_size()}")
-                for k, v in self.model.named_parameters():
-                    if v.requires_grad and v.grad is None:
-                        print(f"--> {k}")
+            self._timeit(all_time, key="model")
 
             self.total_step += 1
-            self.total_loss += loss.detach()
+            self.total_loss.add_(loss.detach())
             self.total_inst += images.shape[0] * nchunk
             if force_eval or (self.cfg.rank == 0 and self.total_step % self.cfg.running.peep_rate == 0):
-                def grad_norm():
-                    return sum(
-                        [p.grad.norm(p=2) ** 2 for p in self.params if p.grad is not None]
-                    ).item() ** 0.5
                 lr_w = self.optimizer.param_groups[0]['lr']
                 lr_b = self.optimizer.param_groups[1]['lr']
+                scalars = [self.total_loss / self.total_step] + ([] if self.gnorm is None else [self.gnorm])
+                scalars = torch.stack([x.float() for x in scalars]).tolist() # the only sync
+                loss_val = scalars[0]
+                gnorm = f"gnorm {scalars[1]:.2f} " if len(scalars) > 1 else ""
+                self.gnorm = None # reported once; lines off the update steps carry no gnorm
                 self.echo(
-                    f"epoch {iepoch:>4} step {self.total_step}\t" + #gnorm {grad_norm():.2f} " +
-                    f"lr_w {lr_w:.2e} lr_b {lr_b:.2e} loss {self.total_loss / self.total_step:.3f} " + 
-                    f"{self.total_inst / (time.time() - self.start_time):.2f} samples/s" 
+                    f"epoch {iepoch:>4} step {self.total_step}\t{gnorm}" +
+                    f"lr_w {lr_w:.2e} lr_b {lr_b:.2e} loss {loss_val:.3f} " + 
+                    f"{self.total_inst / (time.perf_counter() - self.start_time):.2f} samples/s" 
                 )
             if force_eval or self.total_step % self.cfg.running.save_rate == 0 or (
                     self.cfg.running.save_epoch and self.total_step % len(self.dataloader) == 0
@@ -237,20 +257,23 @@ class Monitor(object):
                     self.echo(f"{report}")
                 if self.cfg.rank == 0:
                     self.save()
-            self.timeit(all_time, key="report")
+            self._timeit(all_time, key="report")
 
         if not self.cfg.optimizer.use_lars and not self.cfg.optimizer.batch_sch:
             self.scheduler.step()
-        self.timeit(all_time, show=True)
+        self._timeit(all_time, show=True)
         
     def infer(self, dataloader, samples=float("inf"), iepoch=0):
-        losses, nsample, nchunk, nbatch = 0, 0, 1, len(dataloader)
-        device_ids = [i for i in range(self.cfg.num_gpus)]
+        if samples <= 0: # nothing would be collected for the report
+            return ""
+        # `loss or 0.` would sync on every batch; keep the sum on device instead
+        losses = torch.zeros((), device=self.device)
+        nsample, nchunk, nbatch = 0, 1, len(dataloader)
         if isinstance(self.model, DistributedDataParallel):
             dataloader.sampler.set_epoch(iepoch)
             nchunk = self.cfg.num_gpus
         peep_rate = max(10, (len(dataloader) // 10))
-        start_time = time.time()
+        start_time = time.perf_counter()
         for ibatch, batch in enumerate(dataloader):
             if nsample >= samples:
                 #print(f"{nsample}\t{ibatch}/{nbatch} continue")
@@ -258,27 +281,43 @@ class Monitor(object):
             images, audios, names = self.make_batch(batch)
             #msg = f"{images[0, 0, 50, 50:55]} {audios[0, 0, 50, 50:55]}" # if ibatch == 0 else ""
             #print(f"{nsample}\t{ibatch}/{nbatch} done {msg}")
-            loss = self.model(images, audios, None, device_ids=device_ids, names=names)
+            loss = self.model(images, audios, None, device_ids=self.device_ids, names=names)
             nsample += images.shape[0] * nchunk
-            losses += loss or 0.
+            if loss is not None: # None on non-zero ranks
+                losses += loss.detach() if torch.is_tensor(loss) else loss
             if self.cfg.rank == 0 and (ibatch + 1) % peep_rate == 0:
                 self.echo(
                     f"step {ibatch}\t" + #gnorm {grad_norm():.2f} " +
-                    f"loss {losses / (ibatch + 1):.8f} " +
-                    f"{nsample / (time.time() - start_time):.2f} samples/s"
+                    f"loss {losses.item() / (ibatch + 1):.8f} " +
+                    f"{nsample / (time.perf_counter() - start_time):.2f} samples/s"
                 )
         model = self.model.module if isinstance(self.model, DistributedDataParallel) else self.model
-        self.echo(f"# sample {nsample}; {nsample / (time.time() - start_time):.2f} samples/s")
+        self.echo(f"# sample {nsample}; {nsample / (time.perf_counter() - start_time):.2f} samples/s")
         return model.report(gold_file=self.gold_file)
 
     def save(self):
         fsave = f"{self.cfg.alias_root}/{self.cfg.model_name}/{self.total_step:08d}.pth"
         self.echo(f"Saving the checkpoint to {fsave}")
-        model = self.model.module if isinstance(self.model, DistributedDataParallel) else self.model
+        self.wait_for_save() # at most one outstanding write
+        # snapshot on cpu before training moves on; bfloat16 halves the size but loses precision
+        dtype = torch.bfloat16 if getattr(self.cfg.running, "save_bf16", False) else None
+        def to_cpu(state_dict):
+            return {
+                k: v.detach().to("cpu", dtype=(dtype if v.is_floating_point() else None), copy=True)
+                for k, v in state_dict.items()
+            }
+        model = self._uncompiled
         checkpoint = {
-            "cfg": self.cfg, "model": model.collect_audio_state_dict(), # model.collect_state_dict(),
+            "cfg": self.cfg, "model": tuple(
+                to_cpu(v) for v in model.collect_audio_state_dict() # model.collect_state_dict(),
+            ),
         }
-        torch.save(checkpoint, fsave)
+        self._save_future = self._saver.submit(torch.save, checkpoint, fsave)
+
+    def wait_for_save(self):
+        if self._save_future is not None: # re-raises errors of the background write
+            self._save_future.result()
+            self._save_future = None
 
     def build_optimizer(self, tunable_params={}):
         if not self.model.training:
@@ -290,9 +329,11 @@ class Monitor(object):
             if self.cfg.rank == 0:
                 pass #self.echo(f"{k} {v.size()}")
         ddp = isinstance(self.model, DistributedDataParallel)
+        tunable_keys = frozenset(tunable_params.keys())
         for k, v in self.model.named_parameters():
-            k = re.sub("^module\.", "", k) if ddp else k
-            if f"{k}" not in tunable_params:
+            k = k[len("module."):] if ddp and k.startswith("module.") else k
+            k = k[len("_orig_mod."):] if k.startswith("_orig_mod.") else k # compiled model
+            if k not in tunable_keys:
                 v.requires_grad = False
         self.echo(f"# param {numel(self.model) / 1e6:.2f}M # tunable {numel(self.model, True) / 1e6:.2f}M.")
         param_groups = [
@@ -310,8 +351,18 @@ class Monitor(object):
         else:
             ocfg = self.cfg.optimizer.optimizer
             scfg = self.cfg.optimizer.scheduler
-            self.optimizer = getattr(torch.optim, ocfg[0])(param_groups, **ocfg[1])
+            optimizer_cls = getattr(torch.optim, ocfg[0])
+            kwargs = {**multi_tensor_kwargs(self.cfg, optimizer_cls, ocfg[1]), **ocfg[1]}
+            self.optimizer = optimizer_cls(param_groups, **kwargs)
             self.scheduler = getattr(torch.optim.lr_scheduler, scfg[0])(self.optimizer, **scfg[1])
+        self._trainable = [p for p in self.params if p.requires_grad] # fixed from now on
+        # config-only conditions of the training step, resolved once
+        self._do_warmup = not self.cfg.optimizer.use_lars and self.cfg.optimizer.warmup
+        self._do_batch_sch = not self.cfg.optimizer.use_lars and self.cfg.optimizer.batch_sch
+        if self._do_warmup: # per-step lr increment during warmup
+            self._warmup_delta = [
+                param_group["initial_lr"] / self.cfg.optimizer.warmup_steps for param_group in self.optimizer.param_groups
+            ]
         if not self.cfg.verbose:
             return
         self.echo(f"Gradienting The Following Parameters:")
@@ -16,7 +16,7 @@ import torch.distributed as dist
 from torch.nn.parallel import data_parallel
 from torch.nn.parallel import DistributedDataParallel
 
-from ..util import numel
+from ..util import numel, build_ddp, multi_tensor_kwargs
 from ..model import build_main_model, extract_model_file
 from ..module import LARS, exclude_bias_or_norm, adjust_learning_rate
 from ..data import build_xfold_dataloader_list as build_dataloader
@@ -34,9 +34,7 @@ class Monitor(object):
             self.model.train(not cfg.eval)
             return #
         tunable_params = model.build(**{"output_dim": output_dim})
-        self.model = DistributedDataParallel(
-            model, device_ids=[cfg.rank], find_unused_parameters=True
-        ) if torch.distributed.is_initialized() else model 
+        self.model = build_ddp(cfg, model) if torch.distributed.is_initialized() else model 
         self.model.train(not cfg.eval)
         self.build_optimizer(tunable_params)
 
@@ -45,9 +43,7 @@ class Monitor(object):
         model = build_main_model(cfg, echo)
         output_dim = len(self.lid2str)
         tunable_params = model.build(**{"output_dim": output_dim})
-        self.model = DistributedDataParallel(
-            model, device_ids=[cfg.rank], find_unused_parameters=True
-        ) if torch.distributed.is_initialized() else model 
+        self.model = build_ddp(cfg, model) if torch.distributed.is_initialized() else model 
         self.model.train(not cfg.eval)
         self.build_optimizer(tunable_params)
 
@@ -375,7 +371,9 @@ class Monitor(object):
         else:
             ocfg = self.cfg.optimizer.optimizer
             scfg = self.cfg.optimizer.scheduler
-            self.optimizer = getattr(torch.optim, ocfg[0])(param_groups, **ocfg[1])
+            optimizer_cls = getattr(torch.optim, ocfg[0])
+            kwargs = {**multi_tensor_kwargs(self.cfg, optimizer_cls, ocfg[1]), **ocfg[1]}
+            self.optimizer = optimizer_cls(param_groups, **kwargs)
             self.scheduler = getattr(torch.optim.lr_scheduler, scfg[0])(self.optimizer, **scfg[1])
         if not self.cfg.verbose:
             return
@@ -22,27 +22,28 @@ class Monitor(Monitor):
 
     def make_batch(self, batch):
         def scale_images(images):
-            if images.dim() != 2 and images.shape[-1] != self.cfg.running.resolution and \
+            resolution = self.cfg.running.resolution # pre-resized images skip the interpolation
+            if images.dim() != 2 and (images.shape[-1] != resolution or images.shape[-2] != resolution) and \
                 list(images.shape[1:]) != [1, 1, 1]:
                 images = F.interpolate(
                     images,
-                    self.cfg.running.resolution,
+                    resolution,
                     mode="bilinear",
                     align_corners=False,
                 )
             return images
         #print(batch[0].shape, batch[1].shape, batch[2].shape, batch[3].shape, batch[4].shape)
-        images = (torch.tensor(batch[0], device=self.device)
+        images = (batch[0].to(self.device, non_blocking=True)
             if self.cfg.model.loss.vp or self.cfg.model.loss.ap else None
         )
         images_v1 = scale_images(
-            torch.tensor(batch[1], device=self.device) # (c, h, w)
+            batch[1].to(self.device, non_blocking=True) # (c, h, w)
         )
         images_v2 = scale_images(
-            torch.tensor(batch[2], device=self.device) # (c, h, w)
+            batch[2].to(self.device, non_blocking=True) # (c, h, w)
         ) if self.cfg.model.loss.vv else None
-        audios_v1 = torch.tensor(batch[3], device=self.device)
-        audios_v2 = (torch.tensor(batch[4], device=self.device)
+        audios_v1 = batch[3].to(self.device, non_blocking=True)
+        audios_v2 = (batch[4].to(self.device, non_blocking=True)
             if self.cfg.model.loss.aa else None
         )
         """
@@ -62,73 +63,68 @@ class Monitor(Monitor):
         return batch # bare tensors
 
     def epoch(self, iepoch):
-        all_time = defaultdict(list)
-        self.timeit(all_time)        
-        device_ids = [i for i in range(self.cfg.num_gpus)]
+        all_time = defaultdict(lambda: [0., 0]) # running (sum, count) per key
+        self._timeit(all_time)        
         nchunk = dist.get_world_size() if torch.distributed.is_initialized() else 1  
         warmup_step_rate = max(self.cfg.optimizer.warmup_steps // 20, 1)
         for step, batch in enumerate(self.dataloader, start=iepoch * len(self.dataloader)):
             images, images_v1, images_v2, audios_v1, audios_v2, _ = self.make_batch(batch)
-            self.timeit(all_time, key="data")
+            self._timeit(all_time, key="data")
 
             if self.cfg.optimizer.use_lars:
                 adjust_learning_rate(self.cfg.optimizer, self.optimizer, self.dataloader, step)
 
             inc = 0
             force_eval = False # recommended by SGDR
-            warmup = not self.cfg.optimizer.use_lars and self.cfg.optimizer.warmup and \
-                (self.total_step + inc) <= self.cfg.optimizer.warmup_steps
+            warmup = self._do_warmup and (self.total_step + inc) <= self.cfg.optimizer.warmup_steps
             # it is important to always warm up lr at the first step otherwise
             # the optimizer will use the default / initial lr
             if warmup and ((self.total_step + inc) % warmup_step_rate == 0 or self.total_step == 0):
-                ratio = ((self.total_step + inc) / self.cfg.optimizer.warmup_steps) # * self.cfg.optimizer.lr
-                for param_group in self.optimizer.param_groups:
-                    param_group['lr'] = ratio * param_group["initial_lr"]
+                for param_group, delta in zip(self.optimizer.param_groups, self._warmup_delta):
+                    param_group['lr'] = (self.total_step + inc) * delta
                 lrs = [param_group['lr'] for param_group in self.optimizer.param_groups]
-                force_eval = lrs == self.scheduler.base_lrs
+                force_eval = (self.total_step + inc) == self.cfg.optimizer.warmup_steps # lr reaches base lr
                 lrs = [f"{lr:.2e}" for lr in lrs]
                 self.echo(f"warmup lr: {' '.join(lrs)} @ {self.total_step}")
 
-            self.optimizer.zero_grad(set_to_none=True)
             with torch.cuda.amp.autocast():
                 loss = self.model(
-                    images, images_v1, audios_v1, device_ids=device_ids,
+                    images, images_v1, audios_v1, device_ids=self.device_ids,
                     text_v1=None, images_v2=images_v2, audios_v2=audios_v2
                 )
             self.scaler.scale(loss).backward()
+            # norm of the unscaled gradients, only on the steps that report it
+            if self.cfg.verbose and (force_eval or (self.total_step + 1) % self.cfg.running.peep_rate == 0):
+                self.scaler.unscale_(self.optimizer)
+                self.gnorm = self.grad_norm()
             self.scaler.step(self.optimizer)
             self.scaler.update()
+            self.optimizer.zero_grad(set_to_none=True)
 
-            if not self.cfg.optimizer.use_lars and self.cfg.optimizer.batch_sch and not warmup:
+            if self._do_batch_sch and not warmup:
                 old_lrs = " ".join([f"{x:.2e}" for x in self.scheduler.get_last_lr()])
                 self.scheduler.step() # after all warmup is completed
                 if isinstance(self.scheduler, (CosineAnnealingWarmRestarts,)):
                     force_eval = self.scheduler.get_last_lr() == self.scheduler.base_lrs
                 #self.echo(f"do step lr {old_lrs}")
 
-            self.timeit(all_time, key="model")
-
-            if False and self.cfg.rank == 0:
-                print(f"doing some check on unused params... {dist.get_world_size()}")
-                for k, v in self.model.named_parameters():
-                    if v.requires_grad and v.grad is None:
-                        print(f"--> {k}")
+            self._timeit(all_time, key="model")
 
             self.total_step += 1
-            self.total_loss += loss.detach()
+            self.total_loss.add_(loss.detach())
             self.total_inst += images.shape[0] * nchunk if images is not None else audios_v1.shape[0] * nchunk
             if force_eval or (self.cfg.rank == 0 and self.total_step % self.cfg.running.peep_rate == 0):
-                def grad_norm():
-                    return sum(
-                        [p.grad.norm(p=2) ** 2 for p in self.params if p.grad is not None]
-                    ).item() ** 0.5
                 lr_w = self.optimizer.param_groups[0]['lr']
                 lr_b = self.optimizer.param_groups[1]['lr']
                 msg = self.model.report(**{"nstep": self.total_step})
+                scalars = [self.total_loss / self.total_step] + ([] if self.gnorm is None else [self.gnorm])
+                scalars = torch.stack([x.float() for x in scalars]).tolist() # the only sync
+                loss_val = scalars[0]
+                gnorm = f"gnorm {scalars[1]:.2f} " if len(scalars) > 1 else ""
                 self.echo(
-                    f"epoch {iepoch:>4} step {self.total_step}\t" + #gnorm {grad_norm():.2f} " +
-                    f"lr_w {lr_w:.2e} lr_b {lr_b:.2e} loss {self.total_loss / self.total_step:.3f} " + 
-                    f"{msg} {self.total_inst / (time.time() - self.start_time):.2f} samples/s" 
+                    f"epoch {iepoch:>4} step {self.total_step}\t{gnorm}" +
+                    f"lr_w {lr_w:.2e} lr_b {lr_b:.2e} loss {loss_val:.3f} " + 
+                    f"{msg} {self.total_inst / (time.perf_counter() - self.start_time):.2f} samples/s" 
                 )
             if force_eval or self.total_step % self.cfg.running.save_rate == 0 or (
                     self.cfg.running.save_epoch and self.total_step % len(self.dataloader) == 0
@@ -145,20 +141,23 @@ class Monitor(Monitor):
                     self.echo(f"{report}")
                 if self.cfg.rank == 0:
                     self.save()
-            self.timeit(all_time, key="report")
+            self._timeit(all_time, key="report")
 
         if not self.cfg.optimizer.use_lars and not self.cfg.optimizer.batch_sch:
             self.scheduler.step()
-        self.timeit(all_time, show=True)
+        self._timeit(all_time, show=True)
         
     def infer(self, dataloader, samples=float("inf"), iepoch=0):
-        losses, nsample, nchunk, nbatch = 0, 0, 1, len(dataloader)
-        device_ids = [i for i in range(self.cfg.num_gpus)]
+        if samples <= 0: # nothing would be collected for the report
+            return ""
+        # `loss or 0.` would sync on every batch; keep the sum on device instead
+        losses = torch.zeros((), device=self.device)
+        nsample, nchunk, nbatch = 0, 1, len(dataloader)
         if isinstance(self.model, DistributedDataParallel):
             dataloader.sampler.set_epoch(iepoch)
             nchunk = self.cfg.num_gpus
         peep_rate = max(10, (len(dataloader) // 10))
-        start_time = time.time()
+        start_time = time.perf_counter()
         for ibatch, batch in enumerate(dataloader):
             if nsample >= samples:
                 #print(f"{nsample}\t{ibatch}/{nbatch} continue")
@@ -166,15 +165,16 @@ class Monitor(Monitor):
             images, images_v1, _, audios_v1, _, names = self.make_batch(batch)
             #msg = f"{images[0, 0, 50, 50:55]} {audios[0, 0, 50, 50:55]}" # if ibatch == 0 else ""
             #print(f"{nsample}\t{ibatch}/{nbatch} done {msg}")
-            loss = self.model(images, images_v1, audios_v1, device_ids=device_ids, names=names)
+            loss = self.model(images, images_v1, audios_v1, device_ids=self.device_ids, names=names)
             nsample += images.shape[0] * nchunk if images is not None else audios_v1.shape[0] * nchunk
-            losses += loss or 0.
+            if loss is not None: # None on non-zero ranks
+                losses += loss.detach() if torch.is_tensor(loss) else loss
             if self.cfg.rank == 0 and (ibatch + 1) % peep_rate == 0:
                 self.echo(
                     f"step {ibatch}\t" + #gnorm {grad_norm():.2f} " +
-                    f"loss {losses / (ibatch + 1):.8f} " +
-                    f"{nsample / (time.time() - start_time):.2f} samples/s"
+                    f"loss {losses.item() / (ibatch + 1):.8f} " +
+                    f"{nsample / (time.perf_counter() - start_time):.2f} samples/s"
                 )
         model = self.model.module if isinstance(self.model, DistributedDataParallel) else self.model
-        self.echo(f"# sample {nsample}; {nsample / (time.time() - start_time):.2f} samples/s")
+        self.echo(f"# sample {nsample}; {nsample / (time.perf_counter() - start_time):.2f} samples/s")
         return model.report(gold_file=self.gold_file)
@@ -1,9 +1,11 @@
 import os
 import logging
 import random
+import inspect
 import numpy
 import torch
 import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
 
 def seed_all_rng(seed):
     random.seed(seed)
@@ -60,3 +62,37 @@ class AverageMeter(object):
     @property
     def average(self):
         return self.sum / self.count
+
+def build_ddp(cfg, model, bucket_cap_mb=25, broadcast_buffers=True):
+    """ bucket_cap_mb and broadcast_buffers default to those of DDP; keep broadcasting buffers
+        for models whose BatchNorm running stats would otherwise drift apart across ranks.
+    """
+    rcfg = cfg.running
+    kwargs = {
+        "device_ids": [cfg.rank], "gradient_as_bucket_view": True,
+        "bucket_cap_mb": getattr(rcfg, "bucket_cap_mb", bucket_cap_mb),
+        "broadcast_buffers": getattr(rcfg, "broadcast_buffers", broadcast_buffers),
+    }
+    if "static_graph" in inspect.signature(DistributedDataParallel).parameters:
+        # the one-time graph analysis takes care of frozen / unused parameters, but only when
+        # the same parameters are used at every step; `find_unused` is for those that are not
+        find_unused = getattr(rcfg, "find_unused", False)
+        static_graph = getattr(rcfg, "static_graph", not find_unused)
+        kwargs.update({"static_graph": static_graph, "find_unused_parameters": find_unused})
+    else: # torch < 1.11
+        find_unused = getattr(rcfg, "find_unused", True)
+        kwargs.update({"find_unused_parameters": find_unused})
+    return DistributedDataParallel(model, **kwargs)
+
+def multi_tensor_kwargs(cfg, optimizer_cls, kwargs={}):
+    """ update all parameters with a few multi-tensor kernels instead of one kernel per parameter;
+        `kwargs` are the optimizer arguments from the config, whose `fused` / `foreach` wins outright.
+    """
+    params = inspect.signature(optimizer_cls).parameters
+    if not getattr(cfg.optimizer, "multi_tensor", True) or "fused" in kwargs or "foreach" in kwargs:
+        return {}
+    if "fused" in params and torch.cuda.is_available(): # torch >= 2.0, e.g., Adam / AdamW
+        return {"fused": True}
+    if "foreach" in params: # torch >= 1.12, e.g., SGD / RMSprop
+        return {"foreach": True}
+    return {}